@@ -1,15 +1,18 @@
 mod pmd;
 
-use crate::pmd::{adjust_device_timestamp, PmdUsb, SensorValues};
+use crate::pmd::{
+    get_host_timestamp, PmdUsb, SensorValues, PMD_CONT_TX_BATCH_NUM, PMD_SENSOR_CH_NUM,
+};
 use clap::{Arg, Command};
-use csv::Writer;
+use csv::WriterBuilder;
+use std::fmt::Write as _;
 use std::fs::File;
 use std::io::{stdout, Write};
 use std::sync::atomic::{AtomicBool, Ordering};
-use std::sync::mpsc::{channel, Receiver};
+use std::sync::mpsc::{channel, Receiver, Sender};
 use std::sync::Arc;
 use std::thread;
-use std::time::{Duration, SystemTime};
+use std::time::Duration;
 
 struct Config {
     speed_level: u8,
@@ -17,11 +20,34 @@ struct Config {
     timeout: Duration,
 }
 
+type Record = (u64, Option<u64>, SensorValues);
+
+const CSV_BUFFER_CAPACITY: usize = 1 << 16;
+
+const CSV_HEADER: [&str; PMD_SENSOR_CH_NUM + 2] = [
+    "timestamp",
+    "device_timestamp",
+    "PCIE1_V",
+    "PCIE1_I",
+    "PCIE2_V",
+    "PCIE2_I",
+    "EPS1_V",
+    "EPS1_I",
+    "EPS2_V",
+    "EPS2_I",
+];
+
 fn main() {
     env_logger::init();
 
     /* Set up command line options */
     let args = Command::new("pmd-usb-logger")
+        .after_help(
+            "The timestamp column holds host time in microseconds since the Unix epoch. \
+            At speed levels 2 and 3, it is derived from the device clock, whose own \
+            microseconds go into the device_timestamp column. At speed level 1, the \
+            device_timestamp column stays empty.",
+        )
         .arg(
             Arg::new("port")
                 .short('p')
@@ -131,7 +157,6 @@ fn main() {
     let running = Arc::new(AtomicBool::new(true));
     let running_c = running.clone(); // ctrl+c
     let running_t = running.clone(); // timeout
-    let running_w = running.clone(); // writer
 
     /* Set up interrupt handler */
     ctrlc::set_handler(move || {
@@ -140,15 +165,13 @@ fn main() {
     })
     .expect("Error setting Ctrl-C handler");
 
-    /* Allocate sensor data */
-    let mut timestamp: u128;
-    let mut sensor_values: SensorValues;
-
-    let (tx, rx) = channel::<(u128, SensorValues)>();
+    /* Batches go to the writer and come back empty, so their allocations are reused */
+    let (tx, rx) = channel::<Vec<Record>>();
+    let (recycle_tx, recycle_rx) = channel::<Vec<Record>>();
 
     /* Create a new thread for writing the output file */
     let writer_handle = thread::spawn(move || {
-        log_to_csv(output, rx, running_w);
+        log_to_csv(output, rx, recycle_tx);
     });
 
     /* Switch polling method based on speed level */
@@ -169,14 +192,20 @@ fn main() {
 
     /* Start the main loop */
     while running.load(Ordering::SeqCst) {
-        /* Read sensor values depending on the current polling method */
-        (timestamp, sensor_values) = read_pmd(&mut pmd_usb, &config);
-
-        /* Send current sensor values to the writer */
-        tx.send((timestamp, sensor_values))
+        /* Read a batch of sensor values depending on the current polling method */
+        let mut records = recycle_rx
+            .try_recv()
+            .unwrap_or_else(|_| Vec::with_capacity(PMD_CONT_TX_BATCH_NUM));
+        read_pmd(&mut pmd_usb, &config, &mut records);
+
+        /* Send current batch of sensor values to the writer */
+        tx.send(records)
             .expect("Failed to communicate with CSV writer");
     }
 
+    /* Hang up on the CSV writer so it can write out the remaining batches */
+    drop(tx);
+
     /* Join the timeout thread, if possible */
     if let Some(handle) = timeout_handle {
         handle.join().expect("Failed to join timeout thread");
@@ -198,7 +227,7 @@ fn main() {
     }
 }
 
-fn read_pmd_slow(pmd_usb: &mut PmdUsb, config: &Config) -> (u128, SensorValues) {
+fn read_pmd_slow(pmd_usb: &mut PmdUsb, config: &Config, records: &mut Vec<Record>) {
     let start = std::time::Instant::now();
     let _sensor_values = pmd_usb.read_sensor_values();
     let elapsed = start.elapsed();
@@ -209,22 +238,14 @@ fn read_pmd_slow(pmd_usb: &mut PmdUsb, config: &Config) -> (u128, SensorValues)
     } else {
         Duration::new(0, 0)
     });
-    (timestamp, sensor_values)
+    records.push((timestamp, None, sensor_values));
 }
 
-fn read_pmd_fast(pmd_usb: &mut PmdUsb, _config: &Config) -> (u128, SensorValues) {
-    let timed_adc_buffer = pmd_usb.read_cont_tx();
-    let adc_buffer = timed_adc_buffer.buffer;
-    let timestamp = adjust_device_timestamp(timed_adc_buffer.timestamp);
-    let sensor_values = pmd_usb.convert_adc_values(&adc_buffer);
-    (timestamp, sensor_values)
+fn read_pmd_fast(pmd_usb: &mut PmdUsb, _config: &Config, records: &mut Vec<Record>) {
+    pmd_usb.read_cont_tx_batch(records);
 }
 
-fn log_to_csv(
-    output: Option<String>,
-    rx: Receiver<(u128, SensorValues)>,
-    running: Arc<AtomicBool>,
-) {
+fn log_to_csv(output: Option<String>, rx: Receiver<Vec<Record>>, recycle: Sender<Vec<Record>>) {
     /* Choose either an output file or STDOUT */
     let sink: Box<dyn Write> = match output {
         Some(path) => Box::new(File::create(path).expect("Failed to create output file")),
@@ -232,36 +253,40 @@ fn log_to_csv(
     };
 
     /* Create a new CSV file writer from the sink */
-    let mut csv_writer = Writer::from_writer(sink);
+    let mut csv_writer = WriterBuilder::new()
+        .buffer_capacity(CSV_BUFFER_CAPACITY)
+        .from_writer(sink);
 
     /* Print the CSV header */
     csv_writer
-        .write_record([
-            "timestamp",
-            "PCIE1_V",
-            "PCIE1_I",
-            "PCIE2_V",
-            "PCIE2_I",
-            "EPS1_V",
-            "EPS1_I",
-            "EPS2_V",
-            "EPS2_I",
-        ])
+        .write_record(CSV_HEADER)
         .expect("Failed to write CSV header");
 
-    let mut timestamp: u128;
-    let mut sensor_values: SensorValues;
-
-    while running.load(Ordering::SeqCst) {
-        (timestamp, sensor_values) = rx.recv().unwrap();
-        let sensor_values_string: Vec<String> =
-            sensor_values.iter().map(|v| v.to_string()).collect();
-        csv_writer
-            .write_field(timestamp.to_string())
-            .expect("Failed to write timestamp");
-        csv_writer
-            .write_record(sensor_values_string)
-            .expect("Failed to write CSV record");
+    /* Reuse the same field buffers for every record */
+    let mut fields: [String; PMD_SENSOR_CH_NUM + 2] = Default::default();
+
+    /* Write batches until the main loop hangs up, flushing only once the queue runs dry */
+    while let Ok(records) = rx.recv() {
+        for mut records in std::iter::once(records).chain(rx.try_iter()) {
+            for (timestamp, device_timestamp, sensor_values) in records.drain(..) {
+                for field in fields.iter_mut() {
+                    field.clear();
+                }
+                write!(fields[0], "{}", timestamp).unwrap();
+                if let Some(device_timestamp) = device_timestamp {
+                    write!(fields[1], "{}", device_timestamp).unwrap();
+                }
+                for (field, value) in fields[2..].iter_mut().zip(sensor_values) {
+                    write!(field, "{}", value).unwrap();
+                }
+                csv_writer
+                    .write_record(&fields)
+                    .expect("Failed to write CSV record");
+            }
+
+            /* Hand the empty batch back; the main loop may already be gone */
+            let _ = recycle.send(records);
+        }
         csv_writer.flush().expect("Failed to flush CSV writer");
     }
 }
@@ -274,10 +299,3 @@ fn check_port_validity(port_name: &str) -> bool {
 
     is_valid_port
 }
-
-fn get_host_timestamp() -> u128 {
-    SystemTime::now()
-        .duration_since(SystemTime::UNIX_EPOCH)
-        .unwrap()
-        .as_micros()
-}
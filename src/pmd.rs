@@ -1,10 +1,11 @@
-use bincode::{deserialize, serialize};
+use bincode::{deserialize, serialize_into};
+use serde::de::DeserializeOwned;
 use serde::{Deserialize, Serialize};
 use serialport::SerialPort;
 use std::fmt::Debug;
 use std::io::Write;
 use std::thread;
-use std::time::Duration;
+use std::time::{Duration, SystemTime};
 
 const BAUDRATE_DEFAULT: u32 = 115_200;
 const BAUDRATE_FASTEST: u32 = 460_800; //345_600;//230_400;
@@ -16,13 +17,36 @@ pub const PMD_SENSOR_NUM: usize = 4;
 pub const PMD_SENSOR_CH_NUM: usize = 2 * PMD_SENSOR_NUM;
 pub const PMD_SENSOR_NAME_LEN: usize = 6;
 pub const PMD_SENSOR_BYTE_NUM: usize = PMD_ADC_BYTE_NUM;
+pub const PMD_CONT_TX_FRAME_BYTE_NUM: usize = size_of::<TimedAdcBuffer>();
+pub const PMD_CONT_TX_BATCH_NUM: usize = 256;
+pub const PMD_CONT_TX_READ_BYTE_NUM: usize = PMD_CONT_TX_FRAME_BYTE_NUM * PMD_CONT_TX_BATCH_NUM;
 pub const PMD_USB_PRODUCT_ID: u8 = 0x0A;
 pub const PMD_USB_VENDOR_ID: u8 = 0xEE;
 
 const PMD_ADC_VOLTAGE_SCALE: f64 = 0.007568;
 const PMD_ADC_CURRENT_SCALE: f64 = 0.0488;
+const PMD_ADC_SCALES: [f64; PMD_ADC_CH_NUM] = [
+    PMD_ADC_VOLTAGE_SCALE,
+    PMD_ADC_CURRENT_SCALE,
+    PMD_ADC_VOLTAGE_SCALE,
+    PMD_ADC_CURRENT_SCALE,
+    PMD_ADC_VOLTAGE_SCALE,
+    PMD_ADC_CURRENT_SCALE,
+    PMD_ADC_VOLTAGE_SCALE,
+    PMD_ADC_CURRENT_SCALE,
+];
 const PMD_SENSOR_VOLTAGE_SCALE: f64 = 1.0 / 100.0;
 const PMD_SENSOR_CURRENT_SCALE: f64 = 1.0 / 10.0;
+const PMD_SENSOR_SCALES: [f64; PMD_SENSOR_CH_NUM] = [
+    PMD_SENSOR_VOLTAGE_SCALE,
+    PMD_SENSOR_CURRENT_SCALE,
+    PMD_SENSOR_VOLTAGE_SCALE,
+    PMD_SENSOR_CURRENT_SCALE,
+    PMD_SENSOR_VOLTAGE_SCALE,
+    PMD_SENSOR_CURRENT_SCALE,
+    PMD_SENSOR_VOLTAGE_SCALE,
+    PMD_SENSOR_CURRENT_SCALE,
+];
 const PMD_CLOCK_MULTIPLIER: f64 = 1.0 / 3.0;
 const PMD_TIMEOUT_SECS: u64 = 1;
 
@@ -59,7 +83,7 @@ pub enum UartCommand {
 }
 
 #[repr(C, packed)]
-#[derive(Deserialize, Debug, Default)]
+#[derive(Debug, Default)]
 pub struct TimedAdcBuffer {
     pub timestamp: u32,
     pub buffer: AdcBuffer,
@@ -74,7 +98,7 @@ pub struct DeviceIdStruct {
 }
 
 #[repr(C, packed)]
-#[derive(Deserialize, Default)]
+#[derive(Default)]
 pub struct ReadingStruct {
     pub name: [u8; PMD_SENSOR_NAME_LEN], // because in Rust, a `char` has 4 bytes!
     pub voltage: u16,
@@ -82,6 +106,21 @@ pub struct ReadingStruct {
     pub power: u16,
 }
 
+impl ReadingStruct {
+    /// Parse a single reading straight from its little-endian wire format
+    fn from_bytes(bytes: &[u8]) -> Self {
+        let mut name = [0u8; PMD_SENSOR_NAME_LEN];
+        name.copy_from_slice(&bytes[..PMD_SENSOR_NAME_LEN]);
+        let [voltage, current, power] = words_from_le_bytes(&bytes[PMD_SENSOR_NAME_LEN..]);
+        ReadingStruct {
+            name,
+            voltage,
+            current,
+            power,
+        }
+    }
+}
+
 impl Debug for ReadingStruct {
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
         write!(
@@ -96,11 +135,22 @@ impl Debug for ReadingStruct {
 }
 
 #[repr(C, packed)]
-#[derive(Deserialize, Default)]
+#[derive(Default)]
 pub struct SensorStruct {
     pub sensor: [ReadingStruct; PMD_SENSOR_NUM],
 }
 
+impl SensorStruct {
+    /// Parse all readings without going through the generic deserializer
+    fn from_bytes(bytes: &[u8]) -> Self {
+        SensorStruct {
+            sensor: std::array::from_fn(|i| {
+                ReadingStruct::from_bytes(&bytes[i * size_of::<ReadingStruct>()..])
+            }),
+        }
+    }
+}
+
 #[repr(C, packed)]
 #[derive(Serialize, Deserialize, Debug, Default)]
 pub struct ConfigStruct {
@@ -119,7 +169,7 @@ pub struct ConfigStruct {
     pub oled_rotation: u8,
     pub averaging: u8,
     pub adc_gain_offset: [i8; PMD_ADC_CH_NUM],
-    pub rsvd: [u8; 3],
+    _rsvd: [u8; 3],
 }
 
 #[repr(C, packed)]
@@ -130,6 +180,17 @@ pub struct ContTxStruct {
     pub adc_channels: u8,
 }
 
+pub const CONT_TX_ENABLE: ContTxStruct = ContTxStruct {
+    enable: CONFIG_YES,
+    timestamp_bytes: CONFIG_TIMESTAMP_FULL,
+    adc_channels: CONFIG_MASK_ALL,
+};
+pub const CONT_TX_DISABLE: ContTxStruct = ContTxStruct {
+    enable: CONFIG_NO,
+    timestamp_bytes: CONFIG_TIMESTAMP_FULL, //CONFIG_TIMESTAMP_NONE,
+    adc_channels: CONFIG_MASK_ALL,          //CONFIG_MASK_NONE,
+};
+
 #[repr(C, packed)]
 #[derive(Serialize, Deserialize, Debug, Default)]
 pub struct UartConfigStruct {
@@ -139,11 +200,117 @@ pub struct UartConfigStruct {
     pub stop_bits: u32,
 }
 
+/* The wire formats are fixed by the firmware, so catch layout drift at compile time */
+const _: () = assert!(size_of::<TimedAdcBuffer>() == 20);
+const _: () = assert!(size_of::<DeviceIdStruct>() == 3);
+const _: () = assert!(size_of::<ReadingStruct>() == 12);
+const _: () = assert!(size_of::<SensorStruct>() == 48);
+const _: () = assert!(size_of::<ConfigStruct>() == 34);
+const _: () = assert!(size_of::<ContTxStruct>() == 3);
+const _: () = assert!(size_of::<UartConfigStruct>() == 16);
+
+/// Extends the free-running 32-bit device clock across wrap-arounds and maps
+/// it onto host time. Every batch is re-anchored at its newest frame, so that
+/// drift cannot accumulate, and host timestamps never go backwards.
+struct DeviceClock {
+    device_last: u32,
+    device_ticks: u64,
+    device_anchor: u64,
+    host_anchor: u64,
+    host_last: u64,
+}
+
+impl DeviceClock {
+    fn new(device_timestamp: u32) -> Self {
+        DeviceClock {
+            device_last: device_timestamp,
+            device_ticks: device_timestamp as u64,
+            device_anchor: device_timestamp as u64,
+            host_anchor: 0,
+            host_last: 0,
+        }
+    }
+
+    /// Device ticks up to the given timestamp, counting across a wrap-around
+    fn extend(&self, device_timestamp: u32) -> u64 {
+        self.device_ticks + device_timestamp.wrapping_sub(self.device_last) as u64
+    }
+
+    /// Pin the newest frame of a batch to the host time at which it was read
+    fn anchor(&mut self, host_timestamp: u64, device_timestamp: u32) {
+        self.host_anchor = host_timestamp;
+        self.device_anchor = self.extend(device_timestamp);
+    }
+
+    /// Host and device time of the next frame in microseconds
+    fn timestamps(&mut self, device_timestamp: u32) -> (u64, u64) {
+        self.device_ticks = self.extend(device_timestamp);
+        self.device_last = device_timestamp;
+        let host_timestamp = self.host_anchor.saturating_sub(adjust_device_timestamp(
+            self.device_anchor - self.device_ticks,
+        ));
+        /* Read latency varies from batch to batch, so clamp instead of stepping back */
+        self.host_last = host_timestamp.max(self.host_last + 1);
+        (self.host_last, adjust_device_timestamp(self.device_ticks))
+    }
+}
+
+/// Receive buffer for the continuous TX stream, which carries a trailing
+/// partial frame over to the next read
+struct StreamBuffer {
+    buffer: Box<[u8]>,
+    filled: usize,
+}
+
+impl StreamBuffer {
+    fn new() -> Self {
+        StreamBuffer {
+            buffer: vec![0u8; PMD_CONT_TX_FRAME_BYTE_NUM + PMD_CONT_TX_READ_BYTE_NUM]
+                .into_boxed_slice(),
+            filled: 0,
+        }
+    }
+
+    /// The unused tail of the buffer, to read new data into
+    fn spare(&mut self) -> &mut [u8] {
+        &mut self.buffer[self.filled..]
+    }
+
+    fn advance(&mut self, n: usize) {
+        self.filled += n;
+    }
+
+    fn has_frame(&self) -> bool {
+        self.filled >= PMD_CONT_TX_FRAME_BYTE_NUM
+    }
+
+    /// All complete frames received so far
+    fn frames(&self) -> std::slice::ChunksExact<'_, u8> {
+        let complete = self.filled / PMD_CONT_TX_FRAME_BYTE_NUM * PMD_CONT_TX_FRAME_BYTE_NUM;
+        self.buffer[..complete].chunks_exact(PMD_CONT_TX_FRAME_BYTE_NUM)
+    }
+
+    /// Drop the complete frames and move the trailing partial frame to the front
+    fn consume(&mut self) {
+        let consumed = self.filled / PMD_CONT_TX_FRAME_BYTE_NUM * PMD_CONT_TX_FRAME_BYTE_NUM;
+        self.buffer.copy_within(consumed..self.filled, 0);
+        self.filled -= consumed;
+    }
+
+    fn clear(&mut self) {
+        self.filled = 0;
+    }
+}
+
 pub struct PmdUsb {
     port: Box<dyn SerialPort>,
     device_id: DeviceIdStruct,
     config: ConfigStruct,
-    sensors: SensorStruct,
+    adc_offset: [i16; PMD_ADC_CH_NUM],
+    tx_buffer: Vec<u8>,
+    rx_buffer: Vec<u8>,
+    stream_buffer: StreamBuffer,
+    device_clock: Option<DeviceClock>,
 }
 
 impl PmdUsb {
@@ -161,7 +328,11 @@ impl PmdUsb {
             port,
             device_id: DeviceIdStruct::default(),
             config: ConfigStruct::default(),
-            sensors: SensorStruct::default(),
+            adc_offset: Default::default(),
+            tx_buffer: Vec::with_capacity(1 + size_of::<UartConfigStruct>()),
+            rx_buffer: Vec::with_capacity(size_of::<SensorStruct>()),
+            stream_buffer: StreamBuffer::new(),
+            device_clock: None,
         }
     }
 
@@ -175,75 +346,55 @@ impl PmdUsb {
         self.port.flush().unwrap();
     }
 
-    fn send_data(&mut self, data: &[u8]) {
+    /// Serialize a payload right behind its command into the reusable transmit
+    /// buffer and send both with a single write
+    fn send_command_with_data<T: Serialize>(&mut self, command: UartCommand, data: &T) {
         self.clear_buffers();
-        match self.port.write_all(data) {
-            Ok(_) => log::debug!("Sending data to device: {:?}", data),
+        self.tx_buffer.clear();
+        self.tx_buffer.push(command as u8);
+        serialize_into(&mut self.tx_buffer, data).unwrap();
+        match self.port.write_all(&self.tx_buffer) {
+            Ok(_) => log::debug!("Sending command with data to device: {:?}", self.tx_buffer),
             Err(e) => panic!("Error while writing to device: {}", e),
         }
         self.port.flush().unwrap();
     }
 
-    fn read_data(&mut self, expect: usize) -> Vec<u8> {
-        let mut rx_buffer = vec![0u8; expect];
-        match self.port.read_exact(&mut rx_buffer) {
-            Ok(_) => rx_buffer,
+    /// Read exactly `expect` bytes into the reusable receive buffer
+    fn read_data(&mut self, expect: usize) -> &[u8] {
+        self.rx_buffer.resize(expect, 0);
+        match self.port.read_exact(&mut self.rx_buffer) {
+            Ok(_) => &self.rx_buffer,
             Err(e) => panic!("Error while reading from device: {}", e),
         }
     }
 
-    fn convert_voltage_sensor_values(&self, value: u16) -> f64 {
-        value as f64 * PMD_SENSOR_VOLTAGE_SCALE
-    }
-
-    fn convert_current_sensor_values(&self, value: u16) -> f64 {
-        value as f64 * PMD_SENSOR_CURRENT_SCALE
+    /// Read one reply into the receive buffer and deserialize it in place
+    fn read_struct<T: DeserializeOwned>(&mut self) -> T {
+        let rx_buffer = self.read_data(size_of::<T>());
+        deserialize(rx_buffer).unwrap()
     }
 
     pub fn convert_sensor_values(&self, sensor_values: &SensorBuffer) -> SensorValues {
-        let mut _sensor_values: SensorValues = Default::default();
-        for i in (0..sensor_values.len()).step_by(2) {
-            let j = i + 1;
-            _sensor_values[i] = self.convert_voltage_sensor_values(sensor_values[i]);
-            _sensor_values[j] = self.convert_current_sensor_values(sensor_values[j])
-        }
-        _sensor_values
-    }
-
-    fn convert_voltage_adc_values(&self, value: u16, offset: i8) -> f64 {
-        let value = i16_from_adc(value);
-        (value + (offset as i16)) as f64 * PMD_ADC_VOLTAGE_SCALE
-    }
-
-    fn convert_current_adc_values(&self, value: u16, offset: i8) -> f64 {
-        let value = i16_from_adc(value);
-        (value + (offset as i16)) as f64 * PMD_ADC_CURRENT_SCALE
+        std::array::from_fn(|i| sensor_values[i] as f64 * PMD_SENSOR_SCALES[i])
     }
 
     pub fn convert_adc_values(&self, adc_values: &AdcBuffer) -> SensorValues {
-        let mut _adc_values: SensorValues = Default::default();
-        for i in (0..adc_values.len()).step_by(2) {
-            let j = i + 1;
-            _adc_values[i] =
-                self.convert_voltage_adc_values(adc_values[i], self.config.adc_offset[i]);
-            _adc_values[j] =
-                self.convert_current_adc_values(adc_values[j], self.config.adc_offset[j]);
-        }
-        _adc_values
+        /* Sign-extend all lanes first, so both fixed-width passes map onto SIMD */
+        let samples = adc_values.map(i16_from_adc);
+        std::array::from_fn(|i| (samples[i] + self.adc_offset[i]) as f64 * PMD_ADC_SCALES[i])
     }
 
     pub fn welcome(&mut self) {
         self.send_command(UartCommand::Welcome);
         let response = self.read_data(PMD_WELCOME_RESPONSE.len());
         assert_eq!(response, PMD_WELCOME_RESPONSE);
-        log::debug!("> {}", std::str::from_utf8(&response).unwrap());
+        log::debug!("> {}", std::str::from_utf8(response).unwrap());
     }
 
     pub fn read_device_id(&mut self) -> DeviceIdStruct {
-        self.clear_buffers();
         self.send_command(UartCommand::ReadId);
-        let rx_buffer = self.read_data(size_of::<DeviceIdStruct>());
-        let device_id: DeviceIdStruct = deserialize(&rx_buffer).unwrap();
+        let device_id: DeviceIdStruct = self.read_struct();
         assert_eq!(device_id.product, PMD_USB_PRODUCT_ID, "Invalid product ID");
         assert_eq!(device_id.vendor, PMD_USB_VENDOR_ID, "Invalid vendor ID");
         log::debug!("> Running firmware version {}", device_id.firmware);
@@ -252,40 +403,64 @@ impl PmdUsb {
 
     pub fn read_config(&mut self) -> ConfigStruct {
         self.send_command(UartCommand::ReadConfig);
-        let rx_buffer = self.read_data(size_of::<ConfigStruct>());
-        let config: ConfigStruct = deserialize(&rx_buffer).unwrap();
-        config
-    }
-
-    pub fn write_config(&mut self) {
-        todo!();
+        self.read_struct()
     }
 
     pub fn read_sensors(&mut self) -> SensorStruct {
         self.send_command(UartCommand::ReadSensors);
         let rx_buffer = self.read_data(size_of::<SensorStruct>());
-        deserialize(&rx_buffer).unwrap()
+        SensorStruct::from_bytes(rx_buffer)
     }
 
     pub fn read_sensor_values(&mut self) -> SensorBuffer {
         self.send_command(UartCommand::ReadSensorValues);
         let rx_buffer = self.read_data(PMD_SENSOR_BYTE_NUM);
-        deserialize(&rx_buffer).unwrap()
+        words_from_le_bytes(rx_buffer)
     }
 
     pub fn read_adc_buffer(&mut self) -> AdcBuffer {
         self.send_command(UartCommand::ReadAdcBuffer);
         let rx_buffer = self.read_data(PMD_ADC_BYTE_NUM);
-        deserialize(&rx_buffer).unwrap()
+        words_from_le_bytes(rx_buffer)
     }
 
-    pub fn read_cont_tx(&mut self) -> TimedAdcBuffer {
-        let n_bytes = size_of::<TimedAdcBuffer>();
-        let rx_buffer = self.read_data(n_bytes);
-        deserialize(&rx_buffer).unwrap()
+    /// Read a whole batch of continuous TX frames and convert them in one go
+    pub fn read_cont_tx_batch(&mut self, batch: &mut Vec<(u64, Option<u64>, SensorValues)>) {
+        /* Take whatever the OS has buffered, until there is at least one full frame */
+        while !self.stream_buffer.has_frame() {
+            match self.port.read(self.stream_buffer.spare()) {
+                Ok(n) => self.stream_buffer.advance(n),
+                Err(e) => panic!("Error while reading from device: {}", e),
+            }
+        }
+
+        /* Convert all complete frames and keep the remainder for the next call */
+        let frames = self.stream_buffer.frames();
+        batch.reserve(frames.len());
+        let (device_first, _) =
+            parse_cont_tx_frame(frames.clone().next().unwrap().try_into().unwrap());
+        let (device_newest, _) =
+            parse_cont_tx_frame(frames.clone().last().unwrap().try_into().unwrap());
+        let mut device_clock = self
+            .device_clock
+            .take()
+            .unwrap_or_else(|| DeviceClock::new(device_first));
+        device_clock.anchor(get_host_timestamp(), device_newest);
+        for frame in frames {
+            let (device_timestamp, adc_buffer) = parse_cont_tx_frame(frame.try_into().unwrap());
+            let (host_timestamp, device_timestamp) = device_clock.timestamps(device_timestamp);
+            batch.push((
+                host_timestamp,
+                Some(device_timestamp),
+                self.convert_adc_values(&adc_buffer),
+            ));
+        }
+        self.device_clock = Some(device_clock);
+        self.stream_buffer.consume();
     }
 
     fn clear_buffers(&mut self) {
+        self.stream_buffer.clear();
         match self.port.clear(serialport::ClearBuffer::All) {
             Ok(_) => (),
             Err(e) => panic!("Error while clearing serial port: {}", e),
@@ -293,14 +468,8 @@ impl PmdUsb {
     }
 
     pub fn write_config_cont_tx(&mut self, config: &ContTxStruct) {
-        /* Tell the PMD to expect an incoming TX config */
-        self.send_command(UartCommand::WriteContTx);
-
-        /* Serialize the configuration struct back into a byte vector */
-        let tx_buffer = serialize(config).unwrap();
-
-        /* Send configuration */
-        self.send_data(tx_buffer.as_slice());
+        /* Send the configuration right behind the command that announces it */
+        self.send_command_with_data(UartCommand::WriteContTx, config);
 
         /* Wait for the device to apply new config */
         log::debug!("Waiting for device to process configuration");
@@ -308,38 +477,26 @@ impl PmdUsb {
     }
 
     pub fn enable_cont_tx(&mut self) {
-        self.clear_buffers();
         log::debug!("Starting cont TX");
-        let config = ContTxStruct {
-            enable: CONFIG_YES,
-            timestamp_bytes: CONFIG_TIMESTAMP_FULL,
-            adc_channels: CONFIG_MASK_ALL,
-        };
-        self.write_config_cont_tx(&config);
+        self.device_clock = None;
+        self.write_config_cont_tx(&CONT_TX_ENABLE);
     }
 
     pub fn disable_cont_tx(&mut self) {
         log::debug!("Stopping cont TX");
-        let config = ContTxStruct {
-            enable: CONFIG_NO,
-            timestamp_bytes: CONFIG_TIMESTAMP_FULL, //CONFIG_TIMESTAMP_NONE,
-            adc_channels: CONFIG_MASK_ALL,          //CONFIG_MASK_NONE,
-        };
-        self.write_config_cont_tx(&config);
+        self.write_config_cont_tx(&CONT_TX_DISABLE);
         self.clear_buffers();
     }
 
     fn set_baud_rate(&mut self, baud_rate: u32) {
         log::debug!("Setting baud rate to {}", baud_rate);
-        self.send_command(UartCommand::WriteConfigUart);
         let config = UartConfigStruct {
             baud_rate,
             parity: CONFIG_UART_PARITY_NONE,
             data_width: CONFIG_UART_DATA_WIDTH_EIGHT,
             stop_bits: CONFIG_UART_STOP_BITS_ONE,
         };
-        let tx_buffer = serialize(&config).unwrap();
-        self.send_data(tx_buffer.as_slice());
+        self.send_command_with_data(UartCommand::WriteConfigUart, &config);
         thread::sleep(Duration::from_secs(PMD_TIMEOUT_SECS));
         match self.port.set_baud_rate(baud_rate) {
             Ok(_) => {}
@@ -359,29 +516,165 @@ impl PmdUsb {
 
     pub fn init(&mut self) {
         self.disable_cont_tx();
-        self.clear_buffers();
         self.device_id = self.read_device_id();
         self.config = self.read_config();
-        self.sensors = self.read_sensors();
+        self.adc_offset = self.config.adc_offset.map(i16::from);
+        let sensors = self.read_sensors();
+        log::debug!(
+            "> Sensors: {}",
+            sensors
+                .sensor
+                .iter()
+                .map(|reading| String::from_utf8_lossy(&reading.name).trim().to_string())
+                .collect::<Vec<_>>()
+                .join(", ")
+        );
         self.welcome();
     }
 }
 
 /// Scale the device-side timestamp (approx. 3 MHz) to microseconds
-pub fn adjust_device_timestamp(timestamp: u32) -> u128 {
+pub fn adjust_device_timestamp(timestamp: u64) -> u64 {
     let _timestamp = timestamp as f64;
-    (_timestamp * PMD_CLOCK_MULTIPLIER).floor() as u128
+    (_timestamp * PMD_CLOCK_MULTIPLIER).floor() as u64
+}
+
+/// Split a raw continuous TX frame into the device timestamp and ADC words
+#[inline]
+fn parse_cont_tx_frame(frame: &[u8; PMD_CONT_TX_FRAME_BYTE_NUM]) -> (u32, AdcBuffer) {
+    let timestamp = u32::from_le_bytes([frame[0], frame[1], frame[2], frame[3]]);
+    (timestamp, words_from_le_bytes(&frame[size_of::<u32>()..]))
+}
+
+/// Load consecutive little-endian 16-bit words from a raw buffer
+#[inline]
+fn words_from_le_bytes<const N: usize>(bytes: &[u8]) -> [u16; N] {
+    std::array::from_fn(|i| u16::from_le_bytes([bytes[2 * i], bytes[2 * i + 1]]))
 }
 
 /// Little helper to convert signed 12-bit integers from the ADC to i16
+///
+/// The sample sits in the upper 12 bits, so an arithmetic shift does the
+/// sign extension without branching.
+#[inline]
 fn i16_from_adc(value: u16) -> i16 {
-    let value = value >> 4;
+    (value as i16) >> 4
+}
+
+/// Current host time in microseconds since the Unix epoch
+pub fn get_host_timestamp() -> u64 {
+    SystemTime::now()
+        .duration_since(SystemTime::UNIX_EPOCH)
+        .unwrap()
+        .as_micros() as u64
+}
 
-    let value = value & 0x0FFF;
+#[cfg(test)]
+mod tests {
+    use super::*;
 
-    if (value & 0x0800) != 0 {
-        (value | 0xF000) as i16
-    } else {
-        value as i16
+    const HOST_ANCHOR: u64 = 1_700_000_000_000_000;
+
+    /// The original mask-and-branch sign extension
+    fn i16_from_adc_reference(value: u16) -> i16 {
+        let value = value >> 4;
+        let value = value & 0x0FFF;
+        if (value & 0x0800) != 0 {
+            (value | 0xF000) as i16
+        } else {
+            value as i16
+        }
+    }
+
+    #[test]
+    fn i16_from_adc_matches_reference() {
+        for value in 0..=u16::MAX {
+            assert_eq!(
+                i16_from_adc(value),
+                i16_from_adc_reference(value),
+                "{:#06X}",
+                value
+            );
+        }
+    }
+
+    #[test]
+    fn stream_buffer_carries_partial_frames_over() {
+        /* Number the frames by their timestamps and fill their ADC words likewise */
+        let stream: Vec<u8> = (0..5u32)
+            .flat_map(|i| {
+                let mut frame = [i as u8; PMD_CONT_TX_FRAME_BYTE_NUM];
+                frame[..size_of::<u32>()].copy_from_slice(&i.to_le_bytes());
+                frame
+            })
+            .collect();
+
+        /* Feed the stream in chunks that split frames at odd offsets */
+        let mut stream_buffer = StreamBuffer::new();
+        let mut received = Vec::new();
+        let mut offset = 0;
+        for len in [13, 20, 1, 45, 21] {
+            stream_buffer.spare()[..len].copy_from_slice(&stream[offset..offset + len]);
+            stream_buffer.advance(len);
+            offset += len;
+            if stream_buffer.has_frame() {
+                for frame in stream_buffer.frames() {
+                    received.push(parse_cont_tx_frame(frame.try_into().unwrap()));
+                }
+                stream_buffer.consume();
+            }
+            assert_eq!(stream_buffer.filled, offset % PMD_CONT_TX_FRAME_BYTE_NUM);
+        }
+
+        assert_eq!(offset, stream.len());
+        assert_eq!(received.len(), 5);
+        for (i, (timestamp, adc_buffer)) in received.into_iter().enumerate() {
+            assert_eq!(timestamp, i as u32);
+            assert_eq!(adc_buffer, [i as u16 * 0x0101; PMD_ADC_CH_NUM]);
+        }
+    }
+
+    #[test]
+    fn device_clock_extends_across_wrap_around() {
+        let mut device_clock = DeviceClock::new(u32::MAX - 2);
+        device_clock.anchor(HOST_ANCHOR, 3);
+        for (device_timestamp, device_ticks) in [
+            (u32::MAX - 2, u32::MAX as u64 - 2),
+            (u32::MAX, u32::MAX as u64),
+            (3, u32::MAX as u64 + 4),
+        ] {
+            assert_eq!(
+                device_clock.timestamps(device_timestamp).1,
+                adjust_device_timestamp(device_ticks)
+            );
+        }
+        assert_eq!(device_clock.host_last, HOST_ANCHOR);
+    }
+
+    #[test]
+    fn device_clock_never_steps_back_between_batches() {
+        /* Frames 400 us apart, the first batch read 2 ms late, the second 0.1 ms late */
+        let device_timestamps: Vec<u32> = (0..8)
+            .map(|i| (u32::MAX - 5_000).wrapping_add(1_200 * i))
+            .collect();
+        let mut device_clock = DeviceClock::new(device_timestamps[0]);
+        let mut timestamps = Vec::new();
+        for (batch, host_latency) in device_timestamps.chunks(4).zip([2_000, 100]) {
+            let host_newest =
+                HOST_ANCHOR + adjust_device_timestamp(1_200 * timestamps.len() as u64 + 3_600);
+            device_clock.anchor(host_newest + host_latency, batch[3]);
+            for &device_timestamp in batch {
+                timestamps.push(device_clock.timestamps(device_timestamp));
+            }
+        }
+
+        for pair in timestamps.windows(2) {
+            assert!(
+                pair[0].0 < pair[1].0,
+                "host time went backwards: {:?}",
+                pair
+            );
+            assert_eq!(pair[1].1 - pair[0].1, 400);
+        }
     }
 }